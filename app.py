@@ -1,14 +1,14 @@
 #!/usr/bin/env python3
-import aiopg
-import json
+import asyncpg
+import cachetools
+import orjson
 import os
-import uuid
-import psycopg2
+import re
 import asyncio
 import tornado.locks
 import tornado.web
 from tornado.gen import coroutine
-import nest_asyncio
+import uvloop
 
 from tornado.options import define, options
 
@@ -29,14 +29,52 @@ define("db_user", default=os.getenv('DB_USER', 'postgres'),
 define("db_password", default=os.getenv('DB_PASS', 'docker'), 
         help="database password")
 
+define("db_pool_min",
+        default=int(os.getenv('DB_POOL_MIN', 5)),
+        help="minimum number of pooled database connections", type=int)
+define("db_pool_max",
+        default=int(os.getenv('DB_POOL_MAX', 20)),
+        help="maximum number of pooled database connections", type=int)
+
+# ``notes`` is internal and never leaves the database
+SQL_VEHICLE_COLUMNS = 'id, vin, make, model, year, created_at, updated_at'
+SQL_GET_VEHICLE = f'SELECT {SQL_VEHICLE_COLUMNS} FROM vehicles WHERE id=$1'
+SQL_GET_VEHICLES_BY_VIN = f'SELECT {SQL_VEHICLE_COLUMNS} FROM vehicles WHERE vin=$1'
+SQL_GET_VEHICLES_BY_MAKE = f'SELECT {SQL_VEHICLE_COLUMNS} FROM vehicles WHERE make LIKE $1'
+SQL_GET_VEHICLES = f'SELECT {SQL_VEHICLE_COLUMNS} FROM vehicles'
+SQL_INSERT_VEHICLE = (
+    'INSERT INTO vehicles (vin, make, model, year, notes) '
+    'VALUES ($1, $2, $3, $4, $5) '
+    'ON CONFLICT (vin) DO NOTHING '
+    'RETURNING id, created_at, updated_at')
+SQL_DELETE_VEHICLE = 'DELETE FROM vehicles WHERE id=$1'
+
+JSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+JSON_CONTENT_TYPE = 'application/json; charset=UTF-8'
+
+# rows fetched from the server-side cursor per streamed chunk
+STREAM_BATCH_SIZE = 500
+
+_UUID_RE = re.compile(
+    r'\A[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+    r'[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\Z')
+
+VEHICLE_CACHE_SIZE = 10000
+VEHICLE_CACHE_TTL = 30
+
 
 class NoResultError(Exception):
     pass
 
 class Application(tornado.web.Application):
-    def __init__(self):
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(self.get_db())
+    def __init__(self, db):
+        self.db = db
+        # serialized vehicle bodies keyed by vehicle id
+        self.vehicle_cache = cachetools.TTLCache(
+            maxsize=VEHICLE_CACHE_SIZE, ttl=VEHICLE_CACHE_TTL)
+        # bumped on every delete so a read that raced a delete doesn't
+        # put the deleted vehicle back in the cache
+        self.vehicle_cache_generation = 0
         handlers = [
             (r'/ping', PingHandler),
             (r'/api/v1/vehicles', VehiclesHandler),
@@ -49,27 +87,75 @@ class Application(tornado.web.Application):
 
         super(Application, self).__init__(handlers, **settings)
 
-    async def get_db(self):
-        self.db = await aiopg.create_pool(
+    @classmethod
+    async def create(cls):
+        """
+        Create the database pool, then the application around it.
+        Must be called with ``await Application.create()``
+        """
+        return cls(await cls.get_db())
+
+    @staticmethod
+    async def init_connection(conn):
+        # asyncpg decodes uuid columns to its own uuid.UUID subclass,
+        # which orjson refuses to serialize, so hand them out as strings
+        await conn.set_type_codec(
+            'uuid', encoder=str, decoder=str,
+            schema='pg_catalog', format='text')
+
+    @classmethod
+    async def get_db(cls):
+        # asyncpg opens ``min_size`` connections up front and keeps a
+        # per-connection cache of prepared statements
+        return await asyncpg.create_pool(
             host=options.db_host,
             port=options.db_port,
             user=options.db_user,
             password=options.db_password,
-            dbname=options.db_database)
+            database=options.db_database,
+            min_size=options.db_pool_min,
+            max_size=options.db_pool_max,
+            max_inactive_connection_lifetime=1800,
+            timeout=5.0,
+            init=cls.init_connection)
 
     async def close_db(self):
-        async with self.db as pool:
-            pool.close()
+        await self.db.close()
 
 
 class BaseHandler(tornado.web.RequestHandler):
     """
     Base handlers that houses some helper methods
     """
+    def write(self, chunk):
+        """
+        Serialize dicts and lists with orjson, which encodes datetime
+        values natively (uuid columns already arrive as ``str``, see
+        ``Application.init_connection``).
+        """
+        if isinstance(chunk, (dict, list)):
+            self.set_header('Content-Type', JSON_CONTENT_TYPE)
+            chunk = orjson.dumps(chunk, option=JSON_OPTIONS)
+        super().write(chunk)
+
+    def write_error(self, status_code, **kwargs):
+        self.write({'message': self._reason})
+
     @property
     def json(self):
         if getattr(self, '_json', None) is None:
-            self._json = json.loads(self.request.body)
+            body = self.request.body
+            if not body:
+                self._json = {}
+            elif not is_json_content_type(self.request.headers.get('Content-Type', '')):
+                raise tornado.web.HTTPError(415, reason='expected a JSON body')
+            else:
+                try:
+                    self._json = orjson.loads(body)
+                except orjson.JSONDecodeError:
+                    raise tornado.web.HTTPError(400, reason='malformed JSON body')
+                if not isinstance(self._json, dict):
+                    raise tornado.web.HTTPError(400, reason='expected a JSON object')
         return self._json
 
     async def get_json_argument(self, item, deft=None):
@@ -79,29 +165,22 @@ class BaseHandler(tornado.web.RequestHandler):
         """
         return self.json.get(item, deft)
 
-    def row_to_obj(self, row, cur):
-        """
-        Convert a SQL row to an object supporting dict and attribute access
-        """
-        obj = tornado.util.ObjectDict()
-        for val, desc in zip(row, cur.description):
-            obj[desc.name] = val
-        return obj
-
     async def execute(self, stmt, *args):
         """
         Execute a SQL statement.
         Must be called with ``await self.execute(...)``
         """
         async with self.application.db.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(stmt, args)
+            await conn.execute(stmt, *args)
 
     async def delete_query(self, stmt, *args):
+        """
+        Execute a DELETE statement and return the number of deleted rows
+        """
         async with self.application.db.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(stmt, args)
-                return cur.rowcount
+            status = await conn.execute(stmt, *args)
+            # the command status looks like ``DELETE 1``
+            return int(status.split()[-1])
 
     async def query(self, stmt, *args):
         """
@@ -110,13 +189,46 @@ class BaseHandler(tornado.web.RequestHandler):
             results = await self.query(...)
         Or::
             for row in await self.query(...)
+        Each call acquires its own pooled connection, so independent
+        queries can run concurrently::
+            rows, total = await asyncio.gather(self.query(...),
+                                               self.queryone(...))
         """
 
         async with self.application.db.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(stmt, args)
-                return [self.row_to_obj(row, cur)
-                        for row in await cur.fetchall()]
+            rows = await conn.fetch(stmt, *args)
+        if not rows:
+            return []
+        # every row of a result shares the same columns
+        names = list(rows[0].keys())
+        return [dict(zip(names, row)) for row in rows]
+
+    async def query_batches(self, stmt, *args, size=None):
+        """
+        Query through a server-side cursor, yielding lists of at most
+        ``size`` (default ``STREAM_BATCH_SIZE``) results so large results
+        are never held in memory at once.
+        Typical usage::
+            async for rows in self.query_batches(...)
+        The generator holds a pooled connection until it is exhausted, so
+        callers that may stop early must ``aclose()`` it.
+        """
+        if size is None:
+            size = STREAM_BATCH_SIZE
+        async with self.application.db.acquire() as conn:
+            async with conn.transaction():
+                cur = await conn.cursor(stmt, *args)
+                names = None
+                while True:
+                    rows = await cur.fetch(size)
+                    if not rows:
+                        return
+                    if names is None:
+                        names = list(rows[0].keys())
+                    yield [dict(zip(names, row)) for row in rows]
+                    # a short batch means the cursor is exhausted
+                    if len(rows) < size:
+                        return
 
     async def queryone(self, stmt, *args):
         """
@@ -154,13 +266,22 @@ class VehicleDetailHandler(BaseHandler):
             self.write({'message': 'vehicle id is not a valid uuid'})
             return
 
-        try:
-            vehicle = await self.queryone('SELECT * from vehicles where id=%s', vehicle_id)
-        except NoResultError:
-            self.set_status(404)
-            self.write({'message': 'vehicle not found'})
-            return
-        self.write({**vehicle, 'id': str(vehicle['id']), 'created_at': str(vehicle['created_at']), 'updated_at': str(vehicle['updated_at'])})
+        cache = self.application.vehicle_cache
+        body = cache.get(vehicle_id.lower())
+        if body is None:
+            generation = self.application.vehicle_cache_generation
+            try:
+                vehicle = await self.queryone(SQL_GET_VEHICLE, vehicle_id)
+            except NoResultError:
+                self.set_status(404)
+                self.write({'message': 'vehicle not found'})
+                return
+            body = orjson.dumps(vehicle, option=JSON_OPTIONS)
+            if generation == self.application.vehicle_cache_generation:
+                cache[str(vehicle['id'])] = body
+
+        self.set_header('Content-Type', JSON_CONTENT_TYPE)
+        self.write(body)
 
     async def delete(self, vehicle_id=None):
         """
@@ -171,7 +292,9 @@ class VehicleDetailHandler(BaseHandler):
             self.write({'message': 'vehicle id is not a valid uuid'})
             return
 
-        resp = await self.delete_query('DELETE from vehicles where id=%s', vehicle_id)
+        resp = await self.delete_query(SQL_DELETE_VEHICLE, vehicle_id)
+        self.application.vehicle_cache.pop(vehicle_id.lower(), None)
+        self.application.vehicle_cache_generation += 1
         if resp == 0:
             self.set_status(404)
             self.write({'message': 'vehicle not found'})
@@ -191,17 +314,26 @@ class VehiclesHandler(BaseHandler):
         vin = self.get_query_argument('vin', None)
         make = self.get_query_argument('make', None)
         if vin is not None:
-            resp = await self.query('SELECT * from vehicles where vin=%s', vin)
+            batches = self.query_batches(SQL_GET_VEHICLES_BY_VIN, vin)
         elif make is not None:
-            resp = await self.query('SELECT * from vehicles where make like %s', f'%{make}%')
+            batches = self.query_batches(SQL_GET_VEHICLES_BY_MAKE, '%' + make + '%')
         else:
-            resp = await self.query('SELECT * from vehicles')
-        vehicles = [{**x,
-                     'id': str(x['id']),
-                     'created_at': str(x['created_at']),
-                     'updated_at': str(x['updated_at']),
-                     } for x in list(resp)]
-        self.write({'vehicles': vehicles})
+            batches = self.query_batches(SQL_GET_VEHICLES)
+
+        # stream the list out a batch at a time instead of building it whole
+        self.set_header('Content-Type', JSON_CONTENT_TYPE)
+        self.write(b'{"vehicles":[')
+        sep = b''
+        try:
+            async for rows in batches:
+                self.write(sep + b','.join(
+                    orjson.dumps(row, option=JSON_OPTIONS) for row in rows))
+                sep = b','
+                await self.flush()
+        finally:
+            # release the connection right away if the client went away
+            await batches.aclose()
+        self.write(b']}')
 
     async def post(self):
         """
@@ -216,39 +348,46 @@ class VehiclesHandler(BaseHandler):
         }
 
         req = await self.get_json_argument('vehicle')
+        if req is None:
+            self.set_status(400)
+            self.write({'message': 'missing vehicle'})
+            return
+        if not isinstance(req, dict):
+            self.set_status(400)
+            self.write({'message': 'vehicle must be an object'})
+            return
 
         # need to check vin has length of 17
-        if len(req['vin']) != 17:
+        vin = req.get('vin')
+        if not isinstance(vin, str) or len(vin) != 17:
             self.set_status(400)
             self.write({'message': 'incorrect vin length'})
             return
 
-        vehicle.update(req)
-        # need to check for duplicate vehicles via vin
-        resp = await self.query('SELECT * from vehicles where vin=%s', req['vin'])
-        if len(resp) != 0:
-            self.clear()
+        year = req.get('year')
+        if year is not None and (isinstance(year, bool) or not isinstance(year, int)):
             self.set_status(400)
-            self.write({'message': 'duplicate vin'})
+            self.write({'message': 'year must be an integer'})
             return
 
+        vehicle.update(req)
         if vehicle["year"] is not None and vehicle["year"] > 1994:
             vehicle["notes"] = "too old for OBD II"
 
+        # a duplicate vin hits the unique index and inserts nothing
         resp = await self.query(
-            'INSERT INTO vehicles (vin, make, model, year, notes) '
-            'VALUES (%s, %s, %s, %s, %s) '
-            'RETURNING id, created_at, updated_at',
+            SQL_INSERT_VEHICLE,
             vehicle['vin'], vehicle['make'], vehicle['model'],
             vehicle['year'], vehicle['notes']
         )
+        if len(resp) == 0:
+            self.clear()
+            self.set_status(400)
+            self.write({'message': 'duplicate vin'})
+            return
 
         if len(resp) == 1:
-            vehicle.update({
-                'id': str(resp[0]['id']),
-                'created_at': str(resp[0]['created_at']),
-                'updated_at': str(resp[0]['updated_at']),
-            })
+            vehicle.update(resp[0])
             vehicle.pop('notes')
 
             self.set_status(201)
@@ -258,19 +397,19 @@ class VehiclesHandler(BaseHandler):
 
 async def main():
     tornado.options.parse_command_line()
-    app = Application()
+    app = await Application.create()
     app.listen(options.port)
 
     shutdown_event = tornado.locks.Event()
     await shutdown_event.wait()
 
 def is_valid_uuid(val):
-    try:
-        uuid.UUID(str(val))
-        return True
-    except ValueError:
-        return False
+    return bool(val and _UUID_RE.match(val))
+
+def is_json_content_type(val):
+    # media types are case-insensitive and may carry parameters
+    return val.split(';', 1)[0].strip().lower() == 'application/json'
 
 if __name__ == '__main__':
-    nest_asyncio.apply()
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     tornado.ioloop.IOLoop.current().run_sync(main)
@@ -0,0 +1,7 @@
+-- Adds the make trigram index from schema.sql to databases created before it.
+-- Safe to re-run. CONCURRENTLY can't run inside a transaction, so apply this
+-- with plain psql (autocommit), not a wrapping BEGIN/COMMIT.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS vehicles_make_trgm_idx
+  ON vehicles USING gin (make gin_trgm_ops);
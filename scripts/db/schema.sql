@@ -1,6 +1,9 @@
 -- UUID Extension
 CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
 
+-- Trigram Extension
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
 -- updated_at column trigger
 CREATE OR REPLACE FUNCTION set_updated_at_columns()
 RETURNS TRIGGER AS $$
@@ -23,6 +26,9 @@ create table vehicles (
 
 CREATE UNIQUE INDEX vehicles_vin_idx ON vehicles(vin);
 
+-- lets partial matches like make LIKE '%esl%' use an index
+CREATE INDEX vehicles_make_trgm_idx ON vehicles USING gin (make gin_trgm_ops);
+
 CREATE TRIGGER set_updated_at_vehicles
 BEFORE UPDATE ON vehicles
 FOR EACH ROW EXECUTE PROCEDURE set_updated_at_columns();
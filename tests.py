@@ -1,4 +1,4 @@
-import aiopg
+import asyncpg
 import asyncio
 import json
 import os
@@ -9,7 +9,8 @@ import tornado.gen
 import tornado.testing
 import unittest
 import uuid
-import nest_asyncio
+
+from unittest import mock
 
 from tornado.httpclient import AsyncHTTPClient
 from tornado.options import define, options
@@ -35,16 +36,13 @@ class TestBase(tornado.testing.AsyncHTTPTestCase):
         loop.run_until_complete(self.reset())
 
     def tearDown(self):
+        # the pool belongs to the test's loop, so close it before the loop
+        self.io_loop.run_sync(self.app.close_db)
         super().tearDown()
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(self.app.close_db())
 
     async def reset(self):
         async with self.get_db() as pool:
-            async with pool.acquire() as conn:
-                async with conn.cursor() as cur:
-                    await cur.execute('DELETE FROM vehicles')
-                conn.close()
+            await pool.execute('DELETE FROM vehicles')
 
     def get_db(self):
         '''
@@ -58,15 +56,17 @@ class TestBase(tornado.testing.AsyncHTTPTestCase):
         #               - DB_USER=postgres
         #               - DB_DATABASE=vinli_interview
 
-        return aiopg.create_pool(
+        return asyncpg.create_pool(
             host=options.db_host,
             port=options.db_port,
             user=options.db_user,
             password=options.db_password,
-            dbname=options.db_database)
+            database=options.db_database,
+            min_size=1,
+            max_size=1)
 
     def get_app(self):
-        self.app = Application()
+        self.app = self.io_loop.run_sync(Application.create)
         return self.app
 
 
@@ -104,6 +104,77 @@ class VehicleCreate(TestBase):
 
         self.assertEqual(response.code, 400)
 
+    def test_missing_vehicle(self):
+        """
+        Ensure an empty body is rejected
+        """
+        response = self.fetch(
+            self.get_url('/api/v1/vehicles'),
+            method='POST',
+            body='',
+            headers={'content-type': 'application/json'}
+        )
+        self.assertEqual(response.code, 400)
+
+    def test_body_must_be_json(self):
+        """
+        Ensure a non-JSON body is rejected
+        """
+        response = self.fetch(
+            self.get_url('/api/v1/vehicles'),
+            method='POST',
+            body='vin=12345678901234567',
+            headers={'content-type': 'application/x-www-form-urlencoded'}
+        )
+        self.assertEqual(response.code, 415)
+
+        response = self.fetch(
+            self.get_url('/api/v1/vehicles'),
+            method='POST',
+            body='{"vehicle":',
+            headers={'content-type': 'application/json'}
+        )
+        self.assertEqual(response.code, 400)
+
+        response = self.fetch(
+            self.get_url('/api/v1/vehicles'),
+            method='POST',
+            body='{}',
+            headers={'content-type': 'application/jsonx'}
+        )
+        self.assertEqual(response.code, 415)
+
+        # media types are case-insensitive
+        payload = {
+            "vehicle": {
+                "vin": random_vin(),
+                "make": "Ford",
+                "model": "Focus",
+                "year": 2010
+            }
+        }
+        response = self.fetch(
+            self.get_url('/api/v1/vehicles'),
+            method='POST',
+            body=json.dumps(payload),
+            headers={'content-type': 'Application/JSON; charset=UTF-8'}
+        )
+        self.assertEqual(response.code, 201)
+
+    def test_body_must_be_an_object(self):
+        """
+        Ensure JSON bodies and vehicles that aren't objects are rejected
+        """
+        bad_year = json.dumps({"vehicle": {"vin": random_vin(), "year": "2001"}})
+        for body in ('[]', '"x"', '{"vehicle": "x"}', bad_year):
+            response = self.fetch(
+                self.get_url('/api/v1/vehicles'),
+                method='POST',
+                body=body,
+                headers={'content-type': 'application/json'}
+            )
+            self.assertEqual(response.code, 400, body)
+
     def test_unique_vin(self):
         """
         Ensure a VIN can only be written to the database once.
@@ -180,14 +251,10 @@ class VehiclesList(TestBase):
 
         qry = '''
             INSERT INTO vehicles (vin, make, model, year, notes)
-            VALUES (%s, %s, %s, %s, %s)'''
+            VALUES ($1, $2, $3, $4, $5)'''
 
         async with self.get_db() as pool:
-            async with pool.acquire() as conn:
-                async with conn.cursor() as cur:
-                    for i in vehicles:
-                        await cur.execute(qry, i)
-                conn.close()
+            await pool.executemany(qry, vehicles)
 
     def test_get_vehicles_list(self):
         """
@@ -206,6 +273,25 @@ class VehiclesList(TestBase):
         vehicles = json.loads(response.body.decode()).get('vehicles', None)
         self.assertEqual(len(vehicles), 2)
 
+    def test_get_vehicles_list_in_batches(self):
+        """
+        Ensure a list streamed over several batches is still valid JSON
+        """
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self.create_vehicles())
+
+        with mock.patch('app.STREAM_BATCH_SIZE', 1):
+            response = self.fetch(
+                self.get_url('/api/v1/vehicles'),
+                headers={'content-type': 'application/json'}
+            )
+
+        self.assertEqual(response.code, 200)
+
+        vehicles = json.loads(response.body.decode()).get('vehicles', None)
+        self.assertEqual(len(vehicles), 2)
+        self.assertEqual(len({v['id'] for v in vehicles}), 2)
+
     def test_accept_vin_query_param_to_filter(self):
         """
         Ensure it accepts a query param to filter by exact VIN
@@ -243,16 +329,13 @@ class VehiclesDetail(TestBase):
     async def create_vehicle(self):
         vehicle = (random_vin(), 'Tesla', 'Model S', 2018, '',)
 
-        qry = 'INSERT INTO vehicles (vin, make, model, year, notes) VALUES (%s, %s, %s, %s, %s)'
+        qry = 'INSERT INTO vehicles (vin, make, model, year, notes) VALUES ($1, $2, $3, $4, $5)'
 
         async with self.get_db() as pool:
             async with pool.acquire() as conn:
-                async with conn.cursor() as cur:
-                    await cur.execute(qry, vehicle)
-                    await cur.execute('SELECT * from vehicles')
-                    added = await cur.fetchall()
-                    self.vehicle_id = added[0][0]
-                conn.close()
+                await conn.execute(qry, *vehicle)
+                added = await conn.fetch('SELECT * from vehicles')
+                self.vehicle_id = added[0][0]
 
     def test_get_vehicle_detail(self):
         """
@@ -268,6 +351,8 @@ class VehiclesDetail(TestBase):
         self.assertEqual(response.code, 200)
         resp = json.loads(response.body.decode())
         self.assertIsNotNone(resp)
+        self.assertEqual(resp.get('id'), vehicle_id)
+        self.assertNotIn('notes', resp.keys())
 
     def test_vehicle_non_existence(self):
         """
@@ -297,16 +382,13 @@ class VehiclesDelete(TestBase):
     async def create_vehicle(self):
         vehicle = (random_vin(), 'Tesla', 'Model S', 2018, '',)
 
-        qry = 'INSERT INTO vehicles (vin, make, model, year, notes) VALUES (%s, %s, %s, %s, %s)'
+        qry = 'INSERT INTO vehicles (vin, make, model, year, notes) VALUES ($1, $2, $3, $4, $5)'
 
         async with self.get_db() as pool:
             async with pool.acquire() as conn:
-                async with conn.cursor() as cur:
-                    await cur.execute(qry, vehicle)
-                    await cur.execute('SELECT * from vehicles')
-                    added = await cur.fetchall()
-                    self.vehicle_id = added[0][0]
-                conn.close()
+                await conn.execute(qry, *vehicle)
+                added = await conn.fetch('SELECT * from vehicles')
+                self.vehicle_id = added[0][0]
 
     def test_delete_vehicle(self):
         """
@@ -324,6 +406,25 @@ class VehiclesDelete(TestBase):
         resp = json.loads(response.body.decode())
         self.assertIsNotNone(resp)
 
+    def test_deleted_vehicle_is_not_served(self):
+        """
+        Ensure that a deleted vehicle can no longer be retrieved, even
+        after it has been read once.
+        """
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self.create_vehicle())
+        vehicle_id = str(self.vehicle_id)
+        url = self.get_url(f'/api/v1/vehicles/{vehicle_id}')
+
+        response = self.fetch(url)
+        self.assertEqual(response.code, 200)
+
+        response = self.fetch(url, method='DELETE')
+        self.assertEqual(response.code, 200)
+
+        response = self.fetch(url)
+        self.assertEqual(response.code, 404)
+
     def test_delete_vehicle_non_existing(self):
         """
         Ensure that it displays an appropriate error if a vehicle
@@ -347,5 +448,4 @@ class VehiclesDelete(TestBase):
 
 
 if __name__ == '__main__':
-    nest_asyncio.apply()
     unittest.main()